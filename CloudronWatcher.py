@@ -1,20 +1,110 @@
+import asyncio
 import configparser
+import hashlib
+import json
 import shlex
 import os
+import re
+import signal
 import subprocess
 import sys
-import requests
+import time
+import aiohttp
+from yarl import URL
+from collections.abc import Callable
 from datetime import datetime
+from functools import lru_cache
+from operator import itemgetter
 
+try:
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
-def is_debug_mode() -> bool:
+    def json_dumps(data) -> bytes:
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode()
+
+DEBUG = '--debug' in sys.argv
+
+HTTP_CONNECTIONS = 32
+HTTP_CONNECTIONS_PER_HOST = 8
+HTTP_KEEPALIVE_TIMEOUT = 30
+DNS_CACHE_TTL = 300
+HTTP_TIMEOUT = aiohttp.ClientTimeout(total=30, connect=3, sock_read=10)
+HTTP_RETRIES = 2
+HTTP_BACKOFF_FACTOR = 0.3
+HTTP_RETRY_STATUSES = frozenset({429, 502, 503, 504})
+# Longest Retry-After delay waited for, in seconds.
+HTTP_RETRY_AFTER_MAX = 30
+# Cloudron API paths, relative to the base URL of the instance sessions.
+APPS_URL = "/api/v1/apps"
+NOTIFICATIONS_URL = "/api/v1/notifications?acknowledged=false"
+NOTIFICATION_URL = "/api/v1/notifications/"
+# The acknowledgement body is the same for every notification, so it is serialized once.
+ACK_BODY = b'{"acknowledged":true}'
+ACK_HEADERS = {"Content-Type": "application/json"}
+APP_ALERT_RESEND_RUNS = 24
+# The log of acknowledged notification IDs is compacted once it holds more lines than this.
+ACK_LOG_MAX_ENTRIES = 1000
+# By default every notification is delivered as its own message.
+DIGEST_SIZE = 1
+DIGEST_MAX_LENGTH = 4096
+DIGEST_SEPARATOR = "\n---\n"
+# Maximum number of notifications delivered at the same time, across all instances.
+NOTIFICATION_CONCURRENCY = 32
+# A notification command still running after this many seconds is killed and counts as failed.
+NOTIFICATION_CMD_TIMEOUT = 60
+# Colors are only written to terminals, not to log files or cron mails.
+SUCCESS_COLOR, SUCCESS_RESET = ("\033[92m", "\033[0m") if sys.stdout.isatty() else ("", "")
+ERROR_COLOR, WARNING_COLOR, COLOR_RESET = ("\033[m", "\033[33m", "\033[0m") if sys.stderr.isatty() else ("", "", "")
+# After this many failed deliveries in a row, the remaining messages of the check are not sent.
+NOTIFIER_MAX_FAILURES = 3
+SHELL_OPERATORS = frozenset("();<>|&")
+SHELL_GLOB_CHARS = frozenset("*?[")
+# A word such as FOO=1 before the command sets a variable in the shell.
+SHELL_ASSIGNMENT = re.compile(r"[A-Za-z_][A-Za-z0-9_]*=")
+# curl options that do not change the request, as long and as combinable short options.
+CURL_NEUTRAL_OPTIONS = frozenset({"--silent", "--show-error", "--fail", "--location", "--insecure"})
+CURL_NEUTRAL_SHORT_OPTIONS = frozenset("sSfLk")
+# Added to the curl commands that are run as is: HTTP errors give a non-zero exit status and only the error is printed.
+CURL_FAIL_OPTIONS = ("--fail", "--silent", "--show-error")
+# Creation times are displayed as "02 May 2024, 10:00:00", with English month names whatever the locale.
+MONTH_NAMES = ("January", "February", "March", "April", "May", "June", "July", "August", "September",
+               "October", "November", "December")
+# datetime.fromisoformat() accepts the "Z" UTC suffix starting with Python 3.11.
+ISOFORMAT_ACCEPTS_Z = sys.version_info >= (3, 11)
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "cloudronwatcher")
+CREATION_TIME_KEY = itemgetter("creationTime")
+NOTIFICATION_FIELDS = itemgetter("id", "title", "creationTime", "message")
+TEMPLATE_PLACEHOLDERS = re.compile(r"(\{id\}|\{title\}|\{creationTime\}|\{MESSAGE\})")
+
+_cached_config = None
+_cached_sig = None
+
+
+def keep_previous_config(sig) -> tuple:
     """
-    Checks if the script is running in debug mode.
+    Handles an invalid settings.ini, once the error has been reported.
+
+    Parameters:
+    - sig: The modification time and the size of the invalid settings.ini, None if it does not exist.
 
     Returns:
-    - bool: True if the script is running in debug mode, False otherwise.
+    - tuple: The last valid configuration, the script exits if there is none.
     """
-    return '--debug' in sys.argv
+    global _cached_sig
+
+    if _cached_config is None:
+        exit(1)
+
+    # The error is reported once per change of the file, not at every check.
+    _cached_sig = sig
+    print(
+        f"{WARNING_COLOR}Warning: The previous configuration is kept until settings.ini is fixed.{COLOR_RESET}",
+        file=sys.stderr,
+        flush=True,
+    )
+    return _cached_config
 
 
 def get_config() -> tuple:
@@ -25,21 +115,45 @@ def get_config() -> tuple:
     for the Cloudron monitoring tool. It specifically looks for the following settings:
     - NOTIFICATION_CMD: The command used to send notifications.
     - NOTIFICATION_TEMPLATE: The template for the notification messages.
+    - APP_ALERT_RESEND_RUNS (optional): Every how many runs an unchanged failing application is reported again.
+    - DIGEST_SIZE (optional): The maximum number of notifications combined into a single message.
     - CLOUDRON_TOKEN: The API token(s) for accessing the Cloudron instance(s).
     - CLOUDRON_DOMAIN: The domain(s) of the Cloudron instance(s).
+    - POLL_INTERVAL_SECONDS (optional, MONITOR section): The delay between two checks in long-running mode.
 
     Returns:
         tuple: A tuple containing the following elements:
         - cloudron_instances
-        - bash_command (str): The command used to send notifications.
-        - message_template (str): The template for the notification messages.
+        - bash_command (tuple): The command used to send notifications, prepared by
+          parse_notification_command.
+        - message_template (function): The template for the notification messages, compiled by
+          compile_template.
+        - app_alert_resend_runs (int): Every how many runs an unchanged failing application is reported again.
+        - digest_size (int): The maximum number of notifications combined into a single message.
+        - poll_interval (int): The delay between two checks in seconds, 0 to check once and exit.
+
+    The parsed settings are cached and returned as is while the modification time and the size
+    of settings.ini do not change. An invalid configuration stops the script, unless a valid one was
+    loaded before: in long-running mode, the previous configuration is then kept until the file is fixed.
     """
-    config = configparser.ConfigParser()
+    global _cached_config, _cached_sig
 
-    if not os.path.exists("settings.ini"):
-        sys.stderr.write(f"\033[mError: The configuration file 'settings.ini' does not exist.\033[0m\n")
-        sys.stderr.flush()
-        exit(1)
+    config = configparser.ConfigParser(interpolation=None)
+
+    try:
+        st = os.stat("settings.ini")
+    except FileNotFoundError:
+        print(
+            f"{ERROR_COLOR}Error: The configuration file 'settings.ini' does not exist.{COLOR_RESET}",
+            file=sys.stderr,
+            flush=True,
+        )
+        return keep_previous_config(None)
+
+    sig = (st.st_mtime_ns, st.st_size)
+
+    if sig == _cached_sig:
+        return _cached_config
 
     try:
         config.read("settings.ini")
@@ -47,245 +161,1216 @@ def get_config() -> tuple:
         message_template_conf = config["NOTIFICATION"]["NOTIFICATION_TEMPLATE"]
 
         if bash_command_conf == '':
-            sys.stderr.write(
-                f"\033[mConfiguration error: Check the environment variables: NOTIFICATION_CMD.\033[0m\n"
+            print(
+                f"{ERROR_COLOR}Configuration error: Check the environment variables: NOTIFICATION_CMD.{COLOR_RESET}",
+                file=sys.stderr,
+                flush=True,
             )
-            sys.stderr.flush()
-            exit(1)
+            return keep_previous_config(sig)
 
         if message_template_conf == '':
-            sys.stderr.write(
-                f"\033[mConfiguration error: Check the environment variables: NOTIFICATION_TEMPLATE.\033[0m\n"
+            print(
+                f"{ERROR_COLOR}Configuration error: Check the environment variables: "
+                f"NOTIFICATION_TEMPLATE.{COLOR_RESET}",
+                file=sys.stderr,
+                flush=True,
             )
-            sys.stderr.flush()
-            exit(1)
+            return keep_previous_config(sig)
+
+        app_alert_resend_runs_conf = config["NOTIFICATION"].getint(
+            "APP_ALERT_RESEND_RUNS", fallback=APP_ALERT_RESEND_RUNS
+        )
+
+        if app_alert_resend_runs_conf < 1:
+            raise ValueError("APP_ALERT_RESEND_RUNS must be at least 1")
+
+        digest_size_conf = config["NOTIFICATION"].getint("DIGEST_SIZE", fallback=DIGEST_SIZE)
+
+        if digest_size_conf < 1:
+            raise ValueError("DIGEST_SIZE must be at least 1")
+
+        poll_interval_conf = config.getint("MONITOR", "POLL_INTERVAL_SECONDS", fallback=0)
+
+    except (ValueError, configparser.Error) as e:
+        print(
+            f"{ERROR_COLOR}Configuration error: Check the environment variables: {e}.{COLOR_RESET}",
+            file=sys.stderr,
+            flush=True,
+        )
+        return keep_previous_config(sig)
 
     except KeyError as e:
-        sys.stderr.write(
-            f"\033[mConfiguration error: Check the environment variables: {e}.\033[0m\n"
+        print(
+            f"{ERROR_COLOR}Configuration error: Check the environment variables: {e}.{COLOR_RESET}",
+            file=sys.stderr,
+            flush=True,
         )
-        sys.stderr.flush()
-        exit(1)
+        return keep_previous_config(sig)
 
     cloudron_instances_conf = {}
 
     for section in config.sections():
-        if section != 'NOTIFICATION':
-            try:
-                if config[section]["CLOUDRON_DOMAIN"] == '' or config[section]["CLOUDRON_TOKEN"] == '':
-                    sys.stderr.write(
-                        f"\033[33mWarning: The environment variable of {section} is empty. It will be "
-                        f"skipped.\033[0m\n"
-                    )
-                    sys.stderr.flush()
-                else:
-                    cloudron_instances_conf[section] = [config[section]["CLOUDRON_DOMAIN"],
-                                                        config[section]["CLOUDRON_TOKEN"]]
-            except KeyError as e:
-                sys.stderr.write(
-                    f"\033[33mWarning: The environment variable of {section}: No {e} It will be skipped.\033[0m\n"
+        if section not in ('NOTIFICATION', 'MONITOR'):
+            section_conf = config[section]
+            domain = section_conf.get("CLOUDRON_DOMAIN")
+            token = section_conf.get("CLOUDRON_TOKEN")
+
+            if domain is None or token is None:
+                missing = "CLOUDRON_DOMAIN" if domain is None else "CLOUDRON_TOKEN"
+                print(
+                    f"{WARNING_COLOR}Warning: The environment variable of {section}: No '{missing}' It will be "
+                    f"skipped.{COLOR_RESET}",
+                    file=sys.stderr,
+                    flush=True,
+                )
+            elif domain == '' or token == '':
+                print(
+                    f"{WARNING_COLOR}Warning: The environment variable of {section} is empty. It will be "
+                    f"skipped.{COLOR_RESET}",
+                    file=sys.stderr,
+                    flush=True,
                 )
-                sys.stderr.flush()
+            elif not is_valid_domain(domain):
+                print(
+                    f"{WARNING_COLOR}Warning: The environment variable of {section}: '{domain}' is not a valid "
+                    f"CLOUDRON_DOMAIN. It will be skipped.{COLOR_RESET}",
+                    file=sys.stderr,
+                    flush=True,
+                )
+            else:
+                cloudron_instances_conf[section] = [domain, token]
+
+    if not cloudron_instances_conf:
+        print(
+            f"{ERROR_COLOR}Configuration error: No Cloudron instance with CLOUDRON_DOMAIN and "
+            f"CLOUDRON_TOKEN.{COLOR_RESET}",
+            file=sys.stderr,
+            flush=True,
+        )
+        return keep_previous_config(sig)
 
-    return (
+    _cached_sig = sig
+    _cached_config = (
         cloudron_instances_conf,
-        bash_command_conf,
-        message_template_conf,
+        parse_notification_command(bash_command_conf),
+        compile_template(message_template_conf),
+        app_alert_resend_runs_conf,
+        digest_size_conf,
+        poll_interval_conf,
     )
+    return _cached_config
 
 
-def get_cloudron_notifications(cloudron_instance_get: list) -> list:
-    headers = {"Authorization": f"Bearer {cloudron_instance_get[1]}"}
-    url = f"https://{cloudron_instance_get[0]}/api/v1/notifications"
+def is_retryable(error: Exception, attempt: int) -> bool:
+    """
+    Tells if a failed Cloudron API request should be sent again.
 
-    try:
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
+    Parameters:
+    - error (Exception): The error raised by the request.
+    - attempt (int): The number of retries already made.
 
-    except requests.exceptions.RequestException as e:
-        sys.stderr.write(f"\033[mError receiving notifications: {e}.\033[0m\n")
-        sys.stderr.flush()
-        return []
+    Returns:
+    - bool: True for connection errors, timeouts and HTTP_RETRY_STATUSES responses while fewer than
+      HTTP_RETRIES retries were made.
+    """
+    if attempt >= HTTP_RETRIES:
+        return False
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status in HTTP_RETRY_STATUSES
+    return isinstance(error, (aiohttp.ClientConnectionError, asyncio.TimeoutError))
 
-    return sorted(response.json()["notifications"], key=lambda x: x["creationTime"])
 
+def retry_delay(error: Exception, attempt: int) -> float:
+    """
+    Computes how long to wait before sending a failed Cloudron API request again.
 
-def get_apps(cloudron_instance_get: list) -> list:
-    url = f"https://{cloudron_instance_get[0]}/api/v1/apps"
-    headers = {"Authorization": f"Bearer {cloudron_instance_get[1]}"}
+    The delay grows exponentially with the attempts, unless the response asked for a longer one with a
+    Retry-After header (in seconds), which is followed up to HTTP_RETRY_AFTER_MAX.
 
+    Parameters:
+    - error (Exception): The error raised by the request.
+    - attempt (int): The number of retries already made.
+
+    Returns:
+    - float: The delay in seconds.
+    """
+    delay = HTTP_BACKOFF_FACTOR * 2 ** attempt
+
+    if isinstance(error, aiohttp.ClientResponseError) and error.headers:
+        retry_after = error.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            delay = max(delay, min(int(retry_after), HTTP_RETRY_AFTER_MAX))
+    return delay
+
+
+async def fetch_json(session: aiohttp.ClientSession, url: str, http_cache: dict):
+    """
+    Fetches and decodes a JSON document, retrying transient failures.
+
+    Connection errors, timeouts and the HTTP_RETRY_STATUSES responses are retried HTTP_RETRIES times
+    after the delay given by retry_delay. Any other error is raised immediately.
+
+    The request is conditional when a previous response carried an ETag: if the document did not
+    change, the server answers 304 Not Modified without a body and the cached document is returned.
+
+    Parameters:
+    - session (aiohttp.ClientSession): The HTTP session of the Cloudron instance.
+    - url (str): The URL to fetch, relative to the instance.
+    - http_cache (dict): Maps the URLs to the ETag and the document of their last response, updated in place.
+
+    Returns:
+    - The decoded JSON document.
+    """
+    attempt = 0
+    cached = http_cache.get(url)
+    headers = {"If-None-Match": cached[0]} if cached else {}
+
+    while True:
+        try:
+            async with session.get(url, headers=headers) as response:
+                if cached and response.status == 304:
+                    return cached[1]
+
+                response.raise_for_status()
+                document = json_loads(await response.read())
+
+                if "ETag" in response.headers:
+                    http_cache[url] = [response.headers["ETag"], document]
+                else:
+                    http_cache.pop(url, None)
+                return document
+
+        except (aiohttp.ClientConnectionError, aiohttp.ClientResponseError, asyncio.TimeoutError) as e:
+            if not is_retryable(e, attempt):
+                raise
+            delay = retry_delay(e, attempt)
+
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+async def get_cloudron_notifications(session: aiohttp.ClientSession, title: str, http_cache: dict) -> list:
     try:
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
+        notifications = (await fetch_json(session, NOTIFICATIONS_URL, http_cache))["notifications"]
+
+        # The filter is also applied here in case the server ignores the query parameter.
+        return [notification for notification in notifications if not notification["acknowledged"]]
 
-    except requests.exceptions.RequestException as e:
-        sys.stderr.write(
-            f"\033[mError when receiving the application list: {e}.\n\033[0m"
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError, TypeError) as e:
+        # A malformed document is reported like a failed request.
+        print(
+            f"{ERROR_COLOR}{title}: Error receiving notifications: {e}.{COLOR_RESET}",
+            file=sys.stderr,
+            flush=True,
         )
-        sys.stderr.flush()
         return []
 
-    return response.json()
 
+async def get_apps(session: aiohttp.ClientSession, title: str, http_cache: dict) -> list:
+    try:
+        return await fetch_json(session, APPS_URL, http_cache)
 
-def message_update_template(message_template_up: str, notification) -> str:
+    # ValueError covers a body that is not valid JSON or not valid UTF-8.
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        print(
+            f"{ERROR_COLOR}{title}: Error when receiving the application list: {e}.{COLOR_RESET}",
+            file=sys.stderr,
+            flush=True,
+        )
+        return []
+
+
+def parse_creation_time(creation_time: str) -> datetime:
     """
-    Updates a message template with specific notification details.
+    Parses the ISO 8601 creation time of a Cloudron notification.
 
     Parameters:
-    - message_template (str): The template string for the notification message.
-    - notification: A dictionary containing the details of the notification.
+    - creation_time (str): The creation time as returned by the API, e.g. 2024-05-02T10:00:00.000Z.
 
     Returns:
-    - str: The updated message string with all placeholders replaced by the actual notification details.
-    """
-    message_content = message_template_up.replace("{id}", notification["id"])
-    message_content = message_content.replace("{title}", notification["title"])
-    message_content = message_content.replace(
-        "{creationTime}",
-        datetime.fromisoformat(
-            notification["creationTime"].replace("Z", "+00:00")
-        ).strftime("%d %B %Y, %H:%M:%S"),
-    )
-    message_content = message_content.replace("{MESSAGE}", notification["message"])
-    return message_content
+    - datetime: The timezone-aware creation time.
+    """
+    if not ISOFORMAT_ACCEPTS_Z:
+        creation_time = creation_time.replace("Z", "+00:00")
+    return datetime.fromisoformat(creation_time)
+
+
+@lru_cache(maxsize=512)
+def format_creation_time(creation_time: str) -> str:
+    """
+    Formats the creation time of a Cloudron notification for the messages.
+
+    The result is cached, as notifications that could not be delivered are formatted again on the next
+    poll in long-running mode.
+
+    Parameters:
+    - creation_time (str): The creation time as returned by the API.
+
+    Returns:
+    - str: The creation time, e.g. 02 May 2024, 10:00:00.
+    """
+    time_created = parse_creation_time(creation_time)
+    return (f"{time_created.day:02d} {MONTH_NAMES[time_created.month - 1]} {time_created.year}, "
+            f"{time_created.hour:02d}:{time_created.minute:02d}:{time_created.second:02d}")
+
+
+def compile_template(message_template: str) -> Callable[[dict], str]:
+    """
+    Compiles the notification message template once, when the configuration is loaded.
+
+    The placeholders are turned into the positional fields of a format string, and the literal braces
+    of the template are escaped, so that rendering a notification is a single str.format call.
+
+    Parameters:
+    - message_template (str): The NOTIFICATION_TEMPLATE setting.
+
+    Returns:
+    - function: A function rendering the message of a notification (dict).
+    """
+    fields = {"{id}": "{0}", "{title}": "{1}", "{creationTime}": "{2}", "{MESSAGE}": "{3}"}
+    render = "".join([
+        fields.get(part) or part.replace("{", "{{").replace("}", "}}")
+        for part in TEMPLATE_PLACEHOLDERS.split(message_template)
+    ]).format
+    uses_creation_time = "{creationTime}" in message_template
+
+    def message_update_template(notification: dict) -> str:
+        id_notif, title, creation_time, message = NOTIFICATION_FIELDS(notification)
+        if uses_creation_time:
+            creation_time = format_creation_time(creation_time)
+        return render(id_notif, title, creation_time, message)
+
+    return message_update_template
+
+
+def build_digests(title: str, message_template: Callable[[dict], str], notifications: list, digest_size: int) -> list:
+    """
+    Groups the notifications into the messages to deliver.
+
+    Consecutive notifications are combined, separated by DIGEST_SEPARATOR, as long as a message holds at
+    most digest_size notifications and DIGEST_MAX_LENGTH characters. A notification longer than that is
+    delivered alone.
+
+    Parameters:
+    - title (str): The name of the instance, written at the top of every message.
+    - message_template (function): The compiled template for the notification messages.
+    - notifications (list): The notifications to deliver, in order.
+    - digest_size (int): The maximum number of notifications combined into a single message.
+
+    Returns:
+    - list: A (message, notifications) tuple for every message to deliver.
+    """
+    digests = []
+    bodies = []
+    batch = []
+    length = len(title) + 1
+
+    for notification in notifications:
+        body = message_template(notification)
+        added_length = len(body) + (len(DIGEST_SEPARATOR) if batch else 0)
+
+        if batch and (len(batch) >= digest_size or length + added_length > DIGEST_MAX_LENGTH):
+            digests.append((f"{title}\n" + DIGEST_SEPARATOR.join(bodies), batch))
+            bodies = []
+            batch = []
+            length = len(title) + 1
+            added_length = len(body)
+
+        bodies.append(body)
+        batch.append(notification)
+        length += added_length
+
+    if batch:
+        digests.append((f"{title}\n" + DIGEST_SEPARATOR.join(bodies), batch))
+    return digests
+
+
+def unquoted_words(bash_cmd_line: str):
+    """
+    Splits a command line into words as the shell does, masking the quoted and escaped characters.
+
+    Parameters:
+    - bash_cmd_line (str): The command used to send notifications.
+
+    Returns:
+    - list: The words, where every quoted or escaped character is replaced by NUL, so that only the
+      characters the shell interprets remain. An unquoted line break, which separates commands, is kept
+      as a word of its own, and an escaped one is kept in its word. None if a quote is not closed.
+    """
+    words = []
+    word = None
+    quote = None
+    escaped = False
+
+    for char in bash_cmd_line:
+        if escaped:
+            word.append("\n" if char == "\n" else "\0")
+            escaped = False
+        elif quote is not None:
+            if char == quote:
+                quote = None
+            elif char == "\\" and quote == '"':
+                escaped = True
+            else:
+                word.append("\0")
+        elif char.isspace():
+            if word is not None:
+                words.append("".join(word))
+                word = None
+            if char == "\n":
+                words.append(char)
+        else:
+            if word is None:
+                word = []
+            if char == "\\":
+                escaped = True
+            elif char in "'\"":
+                quote = char
+            else:
+                word.append(char)
+
+    if quote is not None or escaped:
+        return None
+    if word is not None:
+        words.append("".join(word))
+    return words
+
+
+def needs_shell(bash_cmd_line: str) -> bool:
+    """
+    Checks if the notification command relies on shell features.
+
+    Pipes, redirections, command lists (including several lines), variables, command substitution, globs,
+    comments and variable assignments before the command can only be interpreted by a shell. Any other command
+    is executed directly, without spawning /bin/sh.
+
+    Parameters:
+    - bash_cmd_line (str): The command used to send notifications.
+
+    Returns:
+    - bool: True if the command has to be run through the shell, False otherwise.
+    """
+    if '$' in bash_cmd_line or '`' in bash_cmd_line:
+        return True
+
+    words = unquoted_words(bash_cmd_line)
+
+    if words is None:
+        return True
+    if words and SHELL_ASSIGNMENT.match(words[0]):
+        return True
+    if any(word.startswith('#') or '\n' in word or not SHELL_GLOB_CHARS.isdisjoint(word) for word in words):
+        return True
+
+    lexer = shlex.shlex(bash_cmd_line, posix=True, punctuation_chars=True)
+    lexer.whitespace_split = True
+
+    try:
+        # An empty quoted word ("") is an argument, not an operator.
+        return any(token and set(token) <= SHELL_OPERATORS or token.startswith('~') for token in lexer)
+    except ValueError:
+        return True
+
+
+def parse_curl_command(argv: list):
+    """
+    Translates a curl command line into an HTTP request that can be sent without spawning curl.
+
+    Only the options commonly used to call a webhook are understood: the URL, -X/--request, -H/--header,
+    -d/--data/--data-raw/--data-binary and -k/--insecure, plus options that do not change the request.
+    As with curl, data turns the request into a form-encoded POST unless told otherwise.
+
+    Parameters:
+    - argv (list): The notification command split into arguments, starting with curl.
 
+    Returns:
+    - tuple: The method, the URL, the headers (dict), the body (str or None) and the TLS verification flag,
+      or None if the command uses anything else, in which case curl itself has to be run.
+    """
+    method = None
+    url = None
+    headers = {}
+    data = []
+    verify_ssl = True
+    args = iter(argv[1:])
+
+    for arg in args:
+        if arg in ("-X", "--request"):
+            method = next(args, None)
+            if method is None:
+                return None
+        elif arg.startswith("-X") and not arg.startswith("--"):
+            method = arg[2:]
+        elif arg in ("-H", "--header"):
+            name, sep, value = next(args, "").partition(":")
+            if not sep:
+                return None
+            headers[name.strip()] = value.strip()
+        elif arg in ("-d", "--data", "--data-raw", "--data-binary"):
+            value = next(args, None)
+            # Except with --data-raw, curl reads the data from a file when it starts with @.
+            if value is None or (arg != "--data-raw" and value.startswith("@")):
+                return None
+            data.append(value)
+        elif arg in CURL_NEUTRAL_OPTIONS or (
+                arg.startswith("-") and not arg.startswith("--") and set(arg[1:]) <= CURL_NEUTRAL_SHORT_OPTIONS):
+            if arg == "--insecure" or (not arg.startswith("--") and "k" in arg):
+                verify_ssl = False
+        elif arg.startswith("-") or url is not None or "://" not in arg:
+            return None
+        else:
+            url = arg
+
+    if url is None:
+        return None
+
+    if data:
+        # Header names are case-insensitive, like curl, which keeps a "content-type" given with -H.
+        if not any(name.lower() == "content-type" for name in headers):
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        return method or "POST", url, headers, "&".join(data), verify_ssl
+    return method or "GET", url, headers, None, verify_ssl
+
+
+def parse_notification_command(bash_cmd_line: str) -> tuple:
+    """
+    Prepares the notification command once, so that it is not parsed again for every message.
+
+    Parameters:
+    - bash_cmd_line (str): The command used to send notifications.
+
+    Returns:
+    - tuple: A tuple containing the following elements:
+        - bash_cmd_line (str): The command line, used as is when the shell is required.
+        - argv (list): The command split into arguments, None if the command needs the shell.
+        - message_indices (list): The indices of the arguments holding a {MESSAGE} or {HTML_MESSAGE} placeholder.
+        - http_request (tuple): The request to send instead of running curl, see parse_curl_command,
+          None if the command is not a supported curl command.
+    """
+    if needs_shell(bash_cmd_line):
+        return bash_cmd_line, None, [], None
+
+    argv = shlex.split(bash_cmd_line)
+    is_curl = bool(argv) and os.path.basename(argv[0]) == "curl"
+    http_request = parse_curl_command(argv) if is_curl else None
+
+    # Without --fail, curl exits with 0 even when the webhook answers with an HTTP error.
+    if is_curl and http_request is None and "--fail-with-body" not in argv:
+        argv[1:1] = [option for option in CURL_FAIL_OPTIONS if option not in argv]
+
+    message_indices = [i for i, arg in enumerate(argv) if "{MESSAGE}" in arg or "{HTML_MESSAGE}" in arg]
+    return bash_cmd_line, argv, message_indices, http_request
+
+
+def fill_message_placeholders(value: str, message_to_deliver: str, html_message_to_deliver: str) -> str:
+    """
+    Replaces the {MESSAGE} and {HTML_MESSAGE} placeholders of a part of the notification command.
+    """
+    value = value.replace("{MESSAGE}", message_to_deliver)
+    return value.replace("{HTML_MESSAGE}", html_message_to_deliver)
+
+
+async def run_notification_command(notification_cmd: tuple, message_to_deliver: str, log_buf: list):
+    """
+    Runs the notification command for a message.
+
+    Parameters:
+    - notification_cmd (tuple): The notification command prepared by parse_notification_command.
+    - message_to_deliver (str): The message to send.
+    - log_buf (list): The output buffer of the instance.
+
+    Returns:
+    - The error output of the command (bytes), or the exception that prevented it from starting or
+      finishing within NOTIFICATION_CMD_TIMEOUT, None if the command succeeded.
+    """
+    bash_cmd_line, argv_template, message_indices, _ = notification_cmd
+    # The message is also written to the standard input, for the commands that read it from there.
+    message_input = message_to_deliver.encode()
+
+    if argv_template is None:
+        message_to_deliver = shlex.quote(message_to_deliver)
+        message_to_deliver = message_to_deliver[1:-1]  # removes first and last quotes (')
+        html_message_to_deliver = '<br/>'.join(message_to_deliver.splitlines())
+
+        bash_cmd_line = fill_message_placeholders(bash_cmd_line, message_to_deliver, html_message_to_deliver)
+
+        if DEBUG:
+            log_buf.append(f"CMD: {bash_cmd_line}\n")
+
+        process = await asyncio.create_subprocess_shell(
+            bash_cmd_line, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            start_new_session=True,
+        )
+    else:
+        html_message_to_deliver = '<br/>'.join(message_to_deliver.splitlines())
+        argv = list(argv_template)
+
+        for i in message_indices:
+            argv[i] = fill_message_placeholders(argv[i], message_to_deliver, html_message_to_deliver)
+
+        if DEBUG:
+            log_buf.append(f"CMD: {shlex.join(argv)}\n")
+
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                start_new_session=True,
+            )
+        except OSError as e:
+            return e
+
+    try:
+        _, stderr = await asyncio.wait_for(process.communicate(message_input), NOTIFICATION_CMD_TIMEOUT)
+    except asyncio.TimeoutError:
+        # The command runs in its own process group, so that the processes started by a shell are killed too.
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        await process.wait()
+        return TimeoutError(f"The command did not finish within {NOTIFICATION_CMD_TIMEOUT} seconds.")
+
+    return stderr if process.returncode != 0 else None
+
+
+async def send_http_notification(notifier_session: aiohttp.ClientSession, http_request: tuple,
+                                 message_to_deliver: str, log_buf: list):
+    """
+    Sends a message with the HTTP request parsed from a curl notification command.
+
+    Parameters:
+    - notifier_session (aiohttp.ClientSession): The HTTP session of the notification backend.
+    - http_request (tuple): The request prepared by parse_curl_command.
+    - message_to_deliver (str): The message to send.
+    - log_buf (list): The output buffer of the instance.
 
-def send_notification(bash_cmd_line: str, message_to_deliver: str, id_notif: str,
-                      message_type: str = "notification") -> bool:
-    message_to_deliver = shlex.quote(message_to_deliver)
-    message_to_deliver = message_to_deliver[1:-1]  # removes first and last quotes (')
+    Returns:
+    - The reason of the failure, a ClientResponseError carrying the status if the backend answered with
+      an error, None if the message was accepted.
+    """
+    method, url, headers, data, verify_ssl = http_request
     html_message_to_deliver = '<br/>'.join(message_to_deliver.splitlines())
 
-    bash_cmd_line = bash_cmd_line.replace("{MESSAGE}", message_to_deliver)
-    bash_cmd_line = bash_cmd_line.replace("{HTML_MESSAGE}", html_message_to_deliver)
+    url = fill_message_placeholders(url, message_to_deliver, html_message_to_deliver)
+    headers = {
+        name: fill_message_placeholders(value, message_to_deliver, html_message_to_deliver)
+        for name, value in headers.items()
+    }
+    if data is not None:
+        data = fill_message_placeholders(data, message_to_deliver, html_message_to_deliver).encode()
 
-    if is_debug_mode():
-        sys.stdout.write(f"CMD: {bash_cmd_line}")
+    if DEBUG:
+        log_buf.append(f"HTTP: {method} {url}\n")
 
-    process = subprocess.run(
-        bash_cmd_line, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-    )
+    try:
+        async with notifier_session.request(method, url, headers=headers, data=data, ssl=verify_ssl) as response:
+            if response.status >= 400:
+                return aiohttp.ClientResponseError(
+                    response.request_info, response.history, status=response.status, message=await response.text(),
+                )
+
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        return e
+
+    return None
+
+
+async def deliver_message(notifier_session: aiohttp.ClientSession, notification_cmd: tuple,
+                          message_to_deliver: str, log_buf: list):
+    """
+    Delivers a message with the notification command, or with an HTTP request for plain curl commands.
+
+    Returns:
+    - The error that prevented the delivery, None if the message was delivered.
+    """
+    http_request = notification_cmd[3]
+
+    if http_request is not None:
+        return await send_http_notification(notifier_session, http_request, message_to_deliver, log_buf)
+    return await run_notification_command(notification_cmd, message_to_deliver, log_buf)
+
+
+def is_notifier_failure(error) -> bool:
+    """
+    Tells whether a failed delivery means that the notifier is unavailable, rather than that it rejected the message.
+
+    Only connection errors, timeouts, failed commands and 5xx or 429 responses count towards
+    NOTIFIER_MAX_FAILURES: a message rejected with another 4xx status would be rejected again on every
+    check, and must not stop the delivery of the others.
+
+    Parameters:
+    - error: The error returned by deliver_message.
+
+    Returns:
+    - bool: True if the failure counts towards NOTIFIER_MAX_FAILURES, False otherwise.
+    """
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status >= 500 or error.status == 429
+    return True
+
+
+async def send_notification(notifier_session: aiohttp.ClientSession, notifier_state: dict,
+                            notification_cmd: tuple, message_to_deliver: str, title: str, id_notif: str,
+                            log_buf: list, message_type: str = "notification") -> bool:
+    # Bounds the number of commands or webhook requests in flight when many messages are pending.
+    async with notifier_state["slots"]:
+        # Until a delivery succeeds, the messages are sent one at a time, so that a notifier that is
+        # down receives at most NOTIFIER_MAX_FAILURES of them.
+        probing = not notifier_state["working"]
+
+        if probing:
+            await notifier_state["probe"].acquire()
+            probing = not notifier_state["working"]
+            if not probing:
+                notifier_state["probe"].release()
+
+        try:
+            # A notifier that keeps failing is not called again until the next check; the messages are
+            # neither acknowledged nor recorded, so they are delivered once it works again.
+            if notifier_state["failures"] >= NOTIFIER_MAX_FAILURES:
+                return False
+
+            error = await deliver_message(notifier_session, notification_cmd, message_to_deliver, log_buf)
+            # Updated before the probe lock is released, so that the next message sees the outcome.
+            notifier_state["working"] = error is None
+            if error is None:
+                notifier_state["failures"] = 0
+            elif is_notifier_failure(error):
+                notifier_state["failures"] += 1
+        finally:
+            if probing:
+                notifier_state["probe"].release()
 
-    if process.returncode != 0:
-        sys.stderr.write(
-            f"\033[mFailed to deliver {id_notif} ({message_type}).\n{process.stderr}"
-            f"\033[0m\n"
+    if error is not None:
+        print(
+            f"{ERROR_COLOR}{title}: Failed to deliver {id_notif} ({message_type}).\n{error}"
+            f"{COLOR_RESET}",
+            file=sys.stderr,
+            flush=True,
         )
-        sys.stderr.flush()
+        if is_notifier_failure(error) and notifier_state["failures"] == NOTIFIER_MAX_FAILURES:
+            print(
+                f"{ERROR_COLOR}The notification command failed {NOTIFIER_MAX_FAILURES} times in a row, the remaining "
+                f"messages will be sent on the next check.{COLOR_RESET}",
+                file=sys.stderr,
+                flush=True,
+            )
         return False
 
-    sys.stdout.write(
-        f"\033[92m\nEvent #{id_notif} has been sent successfully.\033[0m\n"
-    )
-    sys.stdout.flush()
+    log_buf.append(f"{SUCCESS_COLOR}\nEvent #{id_notif} has been sent successfully.{SUCCESS_RESET}\n")
     return True
 
 
-def mark_notification_as_acknowledged(cloudron_instance_mark: list, id_notif: str) -> None:
-    headers = {"Authorization": f"Bearer {cloudron_instance_mark[1]}"}
-    data = {"acknowledged": True}
+async def mark_notification_as_acknowledged(session: aiohttp.ClientSession, title: str, id_notif: str,
+                                            log_buf: list) -> bool:
+    attempt = 0
+
+    # Acknowledging is idempotent, so transient failures are retried like the GET requests.
+    while True:
+        try:
+            async with session.post(f"{NOTIFICATION_URL}{id_notif}", data=ACK_BODY, headers=ACK_HEADERS) as response:
+                response.raise_for_status()
+            break
 
-    url = f"https://{cloudron_instance_mark[0]}/api/v1/notifications/{id_notif}"
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if not is_retryable(e, attempt):
+                print(
+                    f"{ERROR_COLOR}{title}: Failed to ack event #{id_notif}: {e}.{COLOR_RESET}",
+                    file=sys.stderr,
+                    flush=True,
+                )
+                return False
+            delay = retry_delay(e, attempt)
+
+        await asyncio.sleep(delay)
+        attempt += 1
+
+    log_buf.append(f"{SUCCESS_COLOR}Event #{id_notif} marked as read.{SUCCESS_RESET}\n")
+    return True
+
+
+def read_cache(filename: str, default):
+    """
+    Reads a JSON file from the cache directory.
+
+    Parameters:
+    - filename (str): The name of the file in the cache directory.
+    - default: The value returned if the file does not exist or cannot be read.
+
+    Returns:
+    - The decoded content of the file, or the default value.
+    """
+    path = os.path.join(CACHE_DIR, filename)
 
     try:
-        response = requests.post(url, headers=headers, json=data)
-        response.raise_for_status()
+        with open(path) as cache_file:
+            return json.load(cache_file)
+    except FileNotFoundError:
+        return default
+    except (OSError, ValueError) as e:
+        print(
+            f"{WARNING_COLOR}Warning: The cache {path} cannot be read: {e}.{COLOR_RESET}",
+            file=sys.stderr,
+            flush=True,
+        )
+        return default
+
 
-    except requests.exceptions.RequestException as e:
-        sys.stderr.write(
-            f"\033[mFailed to ack event #{id_notif}: {e}.\033[0m"
+def write_cache(filename: str, data) -> None:
+    """
+    Atomically rewrites a JSON file in the cache directory.
+
+    Parameters:
+    - filename (str): The name of the file in the cache directory.
+    - data: The JSON-serializable content of the file.
+    """
+    path = os.path.join(CACHE_DIR, filename)
+    tmp_path = f"{path}.tmp"
+
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(tmp_path, "w") as cache_file:
+            json.dump(data, cache_file)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(
+            f"{WARNING_COLOR}Warning: The cache {path} cannot be written: {e}.{COLOR_RESET}",
+            file=sys.stderr,
+            flush=True,
         )
-        sys.stderr.flush()
+
+
+def read_ack_log(filename: str) -> list:
+    """
+    Reads the acknowledged notification IDs logged in the cache directory, one JSON value per line.
+
+    Parameters:
+    - filename (str): The name of the log in the cache directory.
+
+    Returns:
+    - list: The logged IDs, including duplicates. A line left incomplete by an interrupted run is ignored.
+    """
+    path = os.path.join(CACHE_DIR, filename)
+    ack_ids = []
+
+    try:
+        with open(path, "rb") as ack_log:
+            for line in ack_log:
+                try:
+                    ack_ids.append(json_loads(line))
+                except ValueError:
+                    continue
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(
+            f"{WARNING_COLOR}Warning: The cache {path} cannot be read: {e}.{COLOR_RESET}",
+            file=sys.stderr,
+            flush=True,
+        )
+    return ack_ids
+
+
+def update_ack_log(filename: str, new_ids: list, ack_ids=None) -> None:
+    """
+    Appends acknowledged notification IDs to their log in the cache directory.
+
+    Parameters:
+    - filename (str): The name of the log in the cache directory.
+    - new_ids (list): The IDs acknowledged since the log was read.
+    - ack_ids: All the IDs to keep, given to compact the log: it is then atomically rewritten with
+      these IDs only.
+    """
+    path = os.path.join(CACHE_DIR, filename)
+    lines = b"".join(json_dumps(id_notif) + b"\n" for id_notif in (new_ids if ack_ids is None else ack_ids))
+
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        if ack_ids is None:
+            with open(path, "ab") as ack_log:
+                ack_log.write(lines)
+        else:
+            with open(f"{path}.tmp", "wb") as ack_log:
+                ack_log.write(lines)
+            os.replace(f"{path}.tmp", path)
+    except OSError as e:
+        print(
+            f"{WARNING_COLOR}Warning: The cache {path} cannot be written: {e}.{COLOR_RESET}",
+            file=sys.stderr,
+            flush=True,
+        )
+
+
+def app_state_hash(app: dict) -> str:
+    """
+    Computes a short fingerprint of the run state and the error of an application.
+
+    Parameters:
+    - app (dict): The application as returned by the Cloudron API.
+
+    Returns:
+    - str: The hexadecimal fingerprint.
+    """
+    app_error = app["error"] or {}
+    state = "\0".join([app["runState"], str(app_error.get("message")), str(app_error.get("reason"))])
+    return hashlib.blake2b(state.encode(), digest_size=8).hexdigest()
+
+
+async def fetch_instance(session: aiohttp.ClientSession, title: str) -> tuple:
+    """
+    Fetches the application list and the notifications of a single Cloudron instance in parallel.
+
+    Parameters:
+    - session (aiohttp.ClientSession): The HTTP session of the instance.
+    - title (str): The name of the instance section in settings.ini.
+
+    Returns:
+    - tuple: The title, the application list and the notifications.
+    """
+    http_cache = read_cache(f"{title}.http.json", {})
+    etags = {url: cached[0] for url, cached in http_cache.items()}
+
+    list_apps, list_notifications = await asyncio.gather(
+        get_apps(session, title, http_cache),
+        get_cloudron_notifications(session, title, http_cache),
+    )
+
+    if etags != {url: cached[0] for url, cached in http_cache.items()}:
+        write_cache(f"{title}.http.json", http_cache)
+
+    return title, list_apps, list_notifications
+
+
+async def process_instance(session: aiohttp.ClientSession, notifier_session: aiohttp.ClientSession,
+                           notifier_state: dict, title: str, list_apps, list_notifications: list,
+                           bash_command: tuple, message_template: Callable[[dict], str],
+                           app_alert_resend_runs: int, digest_size: int) -> None:
+    """
+    Checks the applications and delivers the unread notifications of a single Cloudron instance.
+
+    Parameters:
+    - session (aiohttp.ClientSession): The HTTP session of the instance.
+    - notifier_session (aiohttp.ClientSession): The HTTP session used to deliver the notifications.
+    - notifier_state (dict): The semaphore limiting the notifications delivered concurrently ("slots"),
+      the lock sending them one at a time until one is delivered ("probe"), whether the last delivery
+      succeeded ("working") and the number of consecutive delivery failures ("failures"), shared by
+      all instances.
+    - title (str): The name of the instance section in settings.ini.
+    - list_apps: The application list fetched by fetch_instance.
+    - list_notifications (list): The notifications fetched by fetch_instance.
+    - bash_command (tuple): The prepared command used to send notifications.
+    - message_template (function): The compiled template for the notification messages.
+    - app_alert_resend_runs (int): Every how many runs an unchanged failing application is reported again.
+    - digest_size (int): The maximum number of notifications combined into a single message.
+
+    The output of the instance is buffered and written at once when it has been processed, so that
+    the logs of instances checked concurrently do not interleave.
+    """
+    log_buf = [f"{title}...\n"]
+
+    if not (list_apps and list_apps['apps']) and not list_notifications:
+        print("".join(log_buf), end="", flush=True)
         return
 
-    sys.stdout.write(
-        f"\033[92mEvent #{id_notif} marked as read.\033[0m\n"
+    count_app = {"unchanged": 0, "send": 0}
+    failing_apps = []
+    app_messages = []
+    # Maps the ID of every failing app to the fingerprint of its state and the number of runs since it was reported.
+    app_states = read_cache(f"{title}.apps.json", {})
+    checked_app_states = {}
+
+    if list_apps:
+        failing_apps = [
+            app for app in list_apps['apps'] if app["runState"] != "running" or app["error"] is not None
+        ]
+
+    for app in failing_apps:
+        app_title = app["manifest"]["title"]
+        app_error = app["error"]
+        state = app_state_hash(app)
+        previous_state, runs = app_states.get(app["id"], (None, 0))
+
+        if state == previous_state and runs + 1 < app_alert_resend_runs:
+            checked_app_states[app["id"]] = [state, runs + 1]
+            count_app["unchanged"] += 1
+            continue
+
+        if app["runState"] != "running":
+            message = f"{title}\nApplication {app_title} is not running"
+            app_messages.append((message, app_title, "running status", app["id"], state))
+
+        if app_error is not None:
+            message = (f"{title}\nApplication {app_title} is failing.\n{app_error['message']}\n"
+                       f"Reason: {app_error['reason']}")
+            app_messages.append((message, app_title, "error status", app["id"], state))
+
+    app_results = await asyncio.gather(
+        *(send_notification(
+            notifier_session, notifier_state, bash_command, message, title, id_app, log_buf, message_type,
+        ) for message, id_app, message_type, _, _ in app_messages)
     )
-    sys.stdout.flush()
-    return
 
+    for (message, _, _, app_id, state), send_app in zip(app_messages, app_results):
+        if send_app:
+            count_app["send"] += 1
+            if DEBUG:
+                log_buf.append(f"\"{message}\"\n")
+            checked_app_states.setdefault(app_id, [state, 0])
+        else:
+            # Report the app again on the next run.
+            checked_app_states[app_id] = None
 
-if __name__ == '__main__':
-    cloudron_instances, bash_command, message_template = get_config()
+    checked_app_states = {app_id: app_state for app_id, app_state in checked_app_states.items() if app_state}
 
-    current_time = datetime.now().astimezone().strftime("%Y-%m-%d %H:%M:%S")
+    if list_apps and checked_app_states != app_states:
+        write_cache(f"{title}.apps.json", checked_app_states)
 
-    sys.stdout.write(f"Time: {current_time}.\n")
-    sys.stdout.flush()
+    if DEBUG:
+        count_error = sum(app["error"] is not None for app in failing_apps)
+        count_not_running = sum(app["runState"] != "running" for app in failing_apps)
+        count_checked = len(list_apps['apps']) if list_apps else 0
+        log_buf.append(
+            f"Applications:\n\tChecked: {count_checked}\n\tError: {count_error}\n\tNot working: "
+            f"{count_not_running}\n\tUnchanged since last report: {count_app['unchanged']}\n"
+            f"\tSent successfully: {count_app['send']}\n"
+        )
 
-    for title, cloudron_instance in cloudron_instances.items():
+    count_notif = {"send": 0}
+    sent_ids = []
+    unread_notifications = []
+    logged_ack_ids = read_ack_log(f"{title}.acked.jsonl")
+    ack_ids = set(logged_ack_ids)
+    new_ack_ids = []
 
-        sys.stdout.write(f"{title}...\n")
-        sys.stdout.flush()
+    if list_notifications:
+        # Forget the IDs the server no longer returns, they are dropped when the log is compacted.
+        ack_ids.intersection_update(notification["id"] for notification in list_notifications)
 
-        list_apps = get_apps(cloudron_instance)
+        unread_notifications = [
+            notification for notification in list_notifications if notification["id"] not in ack_ids
+        ]
 
-        count_app = {"error": 0, "not_running": 0, "send": 0}
+        # Only the notifications about to be sent are ordered, oldest first.
+        unread_notifications.sort(key=CREATION_TIME_KEY)
 
-        if list_apps:
-            for app in list_apps['apps']:
-                if app["runState"] != "running":
-                    message = f"{title}\nApplication {app['manifest']['title']} is not running"
-                    send_app = send_notification(
-                        bash_command,
-                        message,
-                        str({app["manifest"]["title"]}),
-                        "running status",
-                    )
-                    count_app["not_running"] += 1
-
-                    if send_app:
-                        count_app["send"] += 1
-                        if is_debug_mode():
-                            sys.stdout.write(f"\"{message}\"\n")
-                            sys.stdout.flush()
-
-                if not app["error"] is None:
-                    message = f"{title}\nApplication {app['manifest']['title']} is failing.\n{app['error']['message']}\nReason: {app['error']['reason']}"
-                    send_app = send_notification(
-                        bash_command,
-                        message,
-                        str({app["manifest"]["title"]}),
-                        "error status",
-                    )
-                    count_app["error"] += 1
-
-                    if send_app:
-                        count_app["send"] += 1
-                        if is_debug_mode():
-                            sys.stdout.write(f"\"{message}\"\n")
-                            sys.stdout.flush()
-
-        if is_debug_mode():
-            sys.stdout.write(
-                f"Applications:\n\tChecked: {len(list_apps['apps'])}\n\tError: {count_app['error']}\n\tNot working: "
-                f"{count_app['not_running']}\n\tSent successfully: {count_app['send']}\n"
+    digests = build_digests(title, message_template, unread_notifications, digest_size)
+
+    notif_results = []
+
+    # The notification messages of an instance are sent one after the other, so that they arrive in order.
+    for message, notifications in digests:
+        notif_results.append(await send_notification(
+            notifier_session, notifier_state, bash_command, message, title,
+            ", #".join(notification["id"] for notification in notifications), log_buf,
+        ))
+
+    for (_, notifications), send_status in zip(digests, notif_results):
+        if send_status:
+            count_notif["send"] += len(notifications)
+            for notification in notifications:
+                if DEBUG:
+                    log_buf.append(json_dumps(notification).decode() + "\n")
+                sent_ids.append(notification["id"])
+
+    ack_results = await asyncio.gather(
+        *(mark_notification_as_acknowledged(session, title, id_notif, log_buf)
+          for id_notif in sent_ids),
+        return_exceptions=True,
+    )
+
+    for id_notif, ack_status in zip(sent_ids, ack_results):
+        if ack_status is True:
+            ack_ids.add(id_notif)
+            new_ack_ids.append(id_notif)
+        elif isinstance(ack_status, BaseException):
+            print(
+                f"{ERROR_COLOR}{title}: Failed to ack event #{id_notif}: {ack_status!r}.{COLOR_RESET}",
+                file=sys.stderr,
+                flush=True,
             )
-            sys.stdout.flush()
 
-        list_notifications = get_cloudron_notifications(cloudron_instance)
-        count_notif = {"unread": 0, "send": 0}
+    if len(logged_ack_ids) + len(new_ack_ids) > ACK_LOG_MAX_ENTRIES:
+        update_ack_log(f"{title}.acked.jsonl", new_ack_ids, sorted(ack_ids))
+    elif new_ack_ids:
+        update_ack_log(f"{title}.acked.jsonl", new_ack_ids)
 
-        if list_notifications:
-            for notification in list_notifications:
-                if not notification["acknowledged"]:
-                    count_notif["unread"] += 1
-                    message = f"{title}\n" + message_update_template(
-                        message_template, notification
-                    )
-                    send_status = send_notification(
-                        bash_command, message, notification["id"]
+    if DEBUG:
+        log_buf.append(
+            f"Notifications:\n\tChecked: {len(list_notifications)}\n\tUnread: {len(unread_notifications)}\n\t"
+            f"Sent successfully: {count_notif['send']}\n")
+
+    print("".join(log_buf), end="", flush=True)
+
+
+def create_connector() -> aiohttp.TCPConnector:
+    """
+    Creates the connection pool shared by the sessions of every Cloudron instance.
+
+    Connections are kept alive between requests, so each Cloudron domain pays for the TCP and TLS
+    handshakes once per run instead of once per request.
+
+    Returns:
+    - aiohttp.TCPConnector: The shared connection pool.
+    """
+    return aiohttp.TCPConnector(
+        limit=HTTP_CONNECTIONS,
+        limit_per_host=HTTP_CONNECTIONS_PER_HOST,
+        keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+        ttl_dns_cache=DNS_CACHE_TTL,
+    )
+
+
+def is_valid_domain(domain: str) -> bool:
+    """
+    Checks that a CLOUDRON_DOMAIN can be used as the base URL of the instance session.
+
+    The domain must be a bare host name, optionally with a port, without a scheme, a path or a query.
+
+    Parameters:
+    - domain (str): The domain of the Cloudron instance.
+
+    Returns:
+    - bool: True if the domain is valid, False otherwise.
+    """
+    try:
+        url = URL(f"https://{domain}")
+    except ValueError:
+        return False
+
+    return bool(url.host) and url.origin() == url
+
+
+def create_session(connector: aiohttp.TCPConnector, cloudron_instance: list) -> aiohttp.ClientSession:
+    """
+    Creates the HTTP session of a Cloudron instance on top of the shared connection pool.
+
+    The session carries the base URL and the API token of the instance, so that they are not rebuilt
+    for every request. Responses are requested compressed, which shrinks the JSON payloads several times,
+    and requests time out, so that an unresponsive instance cannot stall the whole run.
+
+    Parameters:
+    - connector (aiohttp.TCPConnector): The shared connection pool.
+    - cloudron_instance (list): The domain and the API token of the instance.
+
+    Returns:
+    - aiohttp.ClientSession: The HTTP session of the instance.
+    """
+    return aiohttp.ClientSession(
+        base_url=f"https://{cloudron_instance[0]}",
+        connector=connector,
+        connector_owner=False,
+        headers={"Authorization": f"Bearer {cloudron_instance[1]}", "Accept-Encoding": "gzip, deflate"},
+        timeout=HTTP_TIMEOUT,
+    )
+
+
+def create_notifier_session(connector: aiohttp.TCPConnector) -> aiohttp.ClientSession:
+    """
+    Creates the HTTP session used to deliver the notifications when NOTIFICATION_CMD is a curl command.
+
+    Parameters:
+    - connector (aiohttp.TCPConnector): The shared connection pool.
+
+    Returns:
+    - aiohttp.ClientSession: The HTTP session of the notification backend.
+    """
+    return aiohttp.ClientSession(connector=connector, connector_owner=False, timeout=HTTP_TIMEOUT)
+
+
+async def check_instances(connector: aiohttp.TCPConnector, cloudron_instances: dict, bash_command: tuple,
+                          message_template: Callable[[dict], str], app_alert_resend_runs: int,
+                          digest_size: int) -> None:
+    """
+    Checks every Cloudron instance once.
+
+    Parameters:
+    - connector (aiohttp.TCPConnector): The shared connection pool.
+    - cloudron_instances (dict): The domain and the API token of every instance, by section name.
+    - bash_command (tuple): The prepared command used to send notifications.
+    - message_template (function): The compiled template for the notification messages.
+    - app_alert_resend_runs (int): Every how many runs an unchanged failing application is reported again.
+    - digest_size (int): The maximum number of notifications combined into a single message.
+    """
+    current_time = time.strftime("%Y-%m-%d %H:%M:%S")
+
+    print(f"Time: {current_time}.", flush=True)
+
+    sessions = {
+        title: create_session(connector, cloudron_instance)
+        for title, cloudron_instance in cloudron_instances.items()
+    }
+    notifier_session = create_notifier_session(connector)
+    notifier_state = {
+        "slots": asyncio.Semaphore(NOTIFICATION_CONCURRENCY),
+        "probe": asyncio.Lock(),
+        "working": False,
+        "failures": 0,
+    }
+
+    try:
+        fetches = {
+            asyncio.create_task(fetch_instance(session, title)): title for title, session in sessions.items()
+        }
+        processing = {}
+
+        # Every instance is processed as soon as its own data arrives, while the others are still fetched.
+        while fetches:
+            done, _ = await asyncio.wait(fetches, return_when=asyncio.FIRST_COMPLETED)
+
+            for fetch in done:
+                title = fetches.pop(fetch)
+
+                try:
+                    _, list_apps, list_notifications = fetch.result()
+                except Exception as e:
+                    # Only this instance is skipped, the others are still fetched and processed.
+                    print(
+                        f"{ERROR_COLOR}Failed to check {title}: {e!r}.{COLOR_RESET}",
+                        file=sys.stderr,
+                        flush=True,
                     )
+                    continue
+
+                processing[title] = asyncio.create_task(process_instance(
+                    sessions[title], notifier_session, notifier_state, title, list_apps, list_notifications,
+                    bash_command, message_template, app_alert_resend_runs, digest_size,
+                ))
+
+        # A failing instance must not interrupt the others while they are still sending and acknowledging.
+        results = await asyncio.gather(*processing.values(), return_exceptions=True)
 
-                    if send_status:
-                        count_notif["send"] += 1
-                        if is_debug_mode():
-                            sys.stdout.write(f"{notification}\n")
-                            sys.stdout.flush()
-                        mark_notification_as_acknowledged(cloudron_instance, notification["id"])
-        if is_debug_mode():
-            sys.stdout.write(
-                f"Notifications:\n\tChecked: {len(list_notifications)}\n\tUnread: {count_notif['unread']}\n\t"
-                f"Sent successfully: {count_notif['send']}\n")
-            sys.stdout.flush()
+        for title, result in zip(processing, results):
+            if isinstance(result, Exception):
+                print(
+                    f"{ERROR_COLOR}Failed to check {title}: {result!r}.{COLOR_RESET}",
+                    file=sys.stderr,
+                    flush=True,
+                )
+    finally:
+        await asyncio.gather(notifier_session.close(), *(session.close() for session in sessions.values()))
+
+
+async def main() -> None:
+    # The connection pool outlives the checks, so that long-running mode reuses its connections.
+    async with create_connector() as connector:
+        while True:
+            (cloudron_instances, bash_command, message_template, app_alert_resend_runs, digest_size,
+             poll_interval) = get_config()
+
+            try:
+                await check_instances(
+                    connector, cloudron_instances, bash_command, message_template, app_alert_resend_runs,
+                    digest_size,
+                )
+            except Exception as e:
+                # In long-running mode, an unexpected error only loses the current check.
+                print(f"{ERROR_COLOR}The check failed: {e!r}.{COLOR_RESET}", file=sys.stderr, flush=True)
+
+            if poll_interval <= 0:
+                break
+
+            await asyncio.sleep(poll_interval)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())